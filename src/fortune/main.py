@@ -5,16 +5,23 @@ Author: Hubert Tournier
 """
 
 import getopt
+import json
 import logging
+import mmap
 import os
 import random
 import re
+import struct
 import sys
+import tempfile
 import time
 
 import strfile
 import rot13
 
+# asyncio is only imported where it is used, as it slows down the start-up of every run:
+# pylint: disable=C0415
+
 # Version string used by the what(1) and ident(1) commands:
 ID = "@(#) $Id: fortune - print a random, hopefully interesting, adage v1.0.3 (September 26, 2021) by Hubert Tournier $"
 
@@ -39,9 +46,28 @@ parameters = {
     "Wait": False,
     "Minimum wait": 6,
     "Characters per second": 20,
+    "Typewriter": False,
     "Command flavour": "",
+    "Corpus file": "",
+    "Build corpus": False,
+}
+
+# Signature of the shared corpus image files:
+CORPUS_MAGIC = b"FORTUNE-CORPUS\x00\x01"
+
+# Fortune file header fields used from the shared corpus image, with their types:
+CORPUS_HEADER_FIELDS = {
+    "number of strings": int,
+    "longest length": int,
+    "shortest length": int,
+    "delimiting char": str,
+    "rotated flag": int,
+    "comments flag": int,
 }
 
+# The shared corpus image currently attached, if any:
+corpus = None
+
 
 ################################################################################
 def initialize_debugging(program_name):
@@ -54,7 +80,7 @@ def initialize_debugging(program_name):
 ################################################################################
 def display_help():
     """Displays usage and help"""
-    print("usage: fortune [--debug] [--help|-?] [--version]", file=sys.stderr)
+    print("usage: fortune [--debug] [--help|-?] [--version] [--build-corpus] [--typewriter]", file=sys.stderr)
     print("       [-acCDefilosw] [-m pattern] [-n length] [-t tries]", file=sys.stderr)
     print("       [--] [[N%] file/directory/all]", file=sys.stderr)
     print("  ----------  -------------------------------------------------------", file=sys.stderr)
@@ -79,6 +105,10 @@ def display_help():
     print("  --debug     Enable debug mode", file=sys.stderr)
     print("  --help|-?   Print usage and this help message and exit", file=sys.stderr)
     print("  --version   Print version and exit", file=sys.stderr)
+    print("  --typewriter", file=sys.stderr)
+    print("              Print the fortune at the reading rate used by -w", file=sys.stderr)
+    print("  --build-corpus", file=sys.stderr)
+    print("              Build a shared corpus image of the selected files and exit", file=sys.stderr)
     print("  --          Options processing terminator", file=sys.stderr)
     print(file=sys.stderr)
 
@@ -151,6 +181,11 @@ def process_environment_variables():
     if "FORTUNE_SAVESTATE" in os.environ.keys():
         parameters["Save state"] = True
 
+    if "FORTUNE_CORPUS" in os.environ.keys():
+        parameters["Corpus file"] = os.environ["FORTUNE_CORPUS"]
+    elif os.name == "posix":
+        parameters["Corpus file"] = "/run/fortune/corpus"
+
     # TODO:
     # To be used one day to diffentiate command behaviour between the Unix V7, BSD
     # and Linux versions.
@@ -177,6 +212,8 @@ def process_command_line():
         "debug",
         "help",
         "version",
+        "build-corpus",
+        "typewriter",
     ]
 
     try:
@@ -207,6 +244,12 @@ def process_command_line():
             print(ID.replace("@(" + "#)" + " $" + "Id" + ": ", "").replace(" $", ""))
             sys.exit(0)
 
+        elif option == "--build-corpus":
+            parameters["Build corpus"] = True
+
+        elif option == "--typewriter":
+            parameters["Typewriter"] = True
+
         elif option == "-a":
             parameters["All files"] = True
             parameters["Offensive only"] = False
@@ -286,16 +329,169 @@ def process_command_line():
     return remaining_arguments
 
 
+################################################################################
+def get_file_stamps(name):
+    """Return the modification times and sizes of a fortune file and its data file"""
+    stamps = []
+    for filename in (name, name + ".dat"):
+        status = os.stat(filename)
+        stamps.append([status.st_mtime, status.st_size])
+
+    return stamps
+
+
+################################################################################
+def load_corpus():
+    """Attach the shared corpus image, if there is one"""
+    # pylint: disable=C0103
+    global corpus
+    # pylint: enable=C0103
+
+    if not parameters["Corpus file"] or not os.path.isfile(parameters["Corpus file"]):
+        return
+
+    try:
+        with open(parameters["Corpus file"], "rb") as file:
+            corpus_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as error:
+        logging.warning("Unable to attach the corpus image: %s", error)
+        return
+
+    if corpus_map[:len(CORPUS_MAGIC)] != CORPUS_MAGIC:
+        logging.warning("'%s' is not a corpus image", parameters["Corpus file"])
+        corpus_map.close()
+        return
+
+    try:
+        index_position, index_length = struct.unpack_from("<QQ", corpus_map, len(CORPUS_MAGIC))
+        index = json.loads(corpus_map[index_position:index_position + index_length].decode("utf-8"))
+    except (struct.error, ValueError):
+        index = None
+
+    if not isinstance(index, dict) \
+    or not all(is_valid_corpus_entry(entry, len(corpus_map)) for entry in index.values()):
+        logging.warning("'%s' is a damaged corpus image", parameters["Corpus file"])
+        corpus_map.close()
+        return
+
+    logging.debug("Attached corpus image %s => %d file(s)", parameters["Corpus file"], len(index))
+    corpus = {"Map": corpus_map, "Index": index}
+
+
+################################################################################
+def is_valid_corpus_entry(entry, corpus_size):
+    """Check that a corpus image index entry is usable"""
+    if not isinstance(entry, dict) \
+    or not isinstance(entry.get("Stamps"), list) \
+    or not isinstance(entry.get("Header"), dict) \
+    or not isinstance(entry.get("Table"), int):
+        return False
+
+    for field, field_type in CORPUS_HEADER_FIELDS.items():
+        if not isinstance(entry["Header"].get(field), field_type):
+            return False
+
+    number_of_strings = entry["Header"]["number of strings"]
+    if number_of_strings < 0:
+        return False
+
+    # The fortunes boundaries table must lie within the image:
+    return 0 <= entry["Table"] and entry["Table"] + 8 * (number_of_strings + 1) <= corpus_size
+
+
+################################################################################
+def get_corpus_entry(name):
+    """Return the shared corpus image entry of a fortune file, if it is up to date"""
+    if corpus is None:
+        return None
+
+    entry = corpus["Index"].get(os.path.abspath(name))
+    if entry is None:
+        return None
+
+    if entry["Stamps"] != get_file_stamps(name):
+        logging.debug("%s has changed since the corpus image was built", name)
+        return None
+
+    return entry
+
+
+################################################################################
+def write_corpus(fortune_files):
+    """Write a shared corpus image of the fortune files"""
+    # The image starts with a signature followed by the position and length of its index.
+    # For each fortune file, it then contains a table of the fortunes boundaries,
+    # followed by the fortunes themselves. The JSON index comes last.
+    corpus_file = parameters["Corpus file"]
+    corpus_directory = os.path.dirname(corpus_file) or "."
+    index = {}
+
+    if not os.path.isdir(corpus_directory):
+        os.makedirs(corpus_directory)
+        # Other users must be able to reach the image, whatever our umask:
+        os.chmod(corpus_directory, 0o755)
+
+    handle, temporary_file = tempfile.mkstemp(dir=corpus_directory)
+    try:
+        with os.fdopen(handle, "wb") as image:
+            image.write(CORPUS_MAGIC + struct.pack("<QQ", 0, 0))
+
+            for file in fortune_files:
+                filename = get_pathname(file)
+                key = os.path.abspath(filename)
+                if key in index:
+                    continue
+
+                number_of_strings = file["Header"]["number of strings"]
+                offsets = strfile.read_strfile_body(filename, number_of_strings)
+                fortunes = []
+                for i in range(number_of_strings):
+                    fortune = strfile.read_fortune(filename, offsets[i], file["Header"]["delimiting char"])
+                    fortunes.append(fortune.encode("utf-8"))
+
+                table = image.tell()
+                position = table + 8 * (number_of_strings + 1)
+                image.write(struct.pack("<Q", position))
+                for fortune in fortunes:
+                    position += len(fortune)
+                    image.write(struct.pack("<Q", position))
+                image.write(b"".join(fortunes))
+
+                index[key] = {"Stamps": get_file_stamps(filename), "Header": file["Header"], "Table": table}
+                logging.debug("%s => %d fortune(s) in corpus image", key, number_of_strings)
+
+            index_data = json.dumps(index).encode("utf-8")
+            index_position = image.tell()
+            image.write(index_data)
+            image.seek(len(CORPUS_MAGIC))
+            image.write(struct.pack("<QQ", index_position, len(index_data)))
+
+        # The image is meant to be shared by all users, and replaced atomically
+        # so that running processes keep their own mapping:
+        os.chmod(temporary_file, 0o644)
+        os.replace(temporary_file, corpus_file)
+    except BaseException:
+        try:
+            os.remove(temporary_file)
+        except OSError:
+            pass
+        raise
+
+
 ################################################################################
 def process_file(name):
     """Return a dictionary describing a fortune file"""
     dirname = os.path.dirname(name)
     basename = os.path.basename(name)
-    header = strfile.read_strfile_header(name)
+    corpus_entry = get_corpus_entry(name)
+    if corpus_entry is None:
+        header = strfile.read_strfile_header(name)
+    else:
+        header = corpus_entry["Header"]
 
     logging.debug("%s / %s => %d fortune(s)", dirname, basename, header["number of strings"])
 
-    return {"Dirname": dirname, "Basename": basename, "Header": header, "Prob": 0}
+    return {"Dirname": dirname, "Basename": basename, "Header": header, "Prob": 0, "Corpus": corpus_entry}
 
 
 ################################################################################
@@ -544,21 +740,61 @@ def list_files(fortune_files):
                 print("{}{:>6.2f}% {}".format(prefix, file["Prob"], file["Basename"]))
 
 
+################################################################################
+def get_pathname(file):
+    """Return the pathname of a fortune file"""
+    if file["Dirname"]:
+        return file["Dirname"] + os.sep + file["Basename"]
+
+    return file["Basename"]
+
+
+################################################################################
+def get_cookie_fortune_reader(file):
+    """Return a function returning the Nth fortune of a fortune file, read from disk"""
+    filename = get_pathname(file)
+    offsets = strfile.read_strfile_body(filename, file["Header"]["number of strings"])
+    delimiter = file["Header"]["delimiting char"]
+
+    return lambda number: strfile.read_fortune(filename, offsets[number], delimiter)
+
+
+################################################################################
+def get_fortune_reader(file):
+    """Return a function returning the Nth fortune of a fortune file"""
+    if file["Corpus"] is None:
+        return get_cookie_fortune_reader(file)
+
+    corpus_map = corpus["Map"]
+    table = file["Corpus"]["Table"]
+    cookie_reader = []
+
+    def read_corpus_fortune(number):
+        try:
+            start, end = struct.unpack_from("<QQ", corpus_map, table + 8 * number)
+            if start > end or end > len(corpus_map):
+                raise ValueError("fortune #{} lies outside of the image".format(number))
+            return corpus_map[start:end].decode("utf-8", "replace")
+        except (struct.error, ValueError) as error:
+            logging.warning("Damaged corpus image, reading %s instead: %s", get_pathname(file), error)
+            if not cookie_reader:
+                cookie_reader.append(get_cookie_fortune_reader(file))
+            return cookie_reader[0](number)
+
+    return read_corpus_fortune
+
+
 ################################################################################
 def search_for_pattern(fortune_files):
     """Print the list of fortunes matching the given pattern"""
     found = False
     for file in fortune_files:
-        if file["Dirname"]:
-            filename = file["Dirname"] + os.sep + file["Basename"]
-        else:
-            filename = file["Basename"]
-        offsets = strfile.read_strfile_body(filename, file["Header"]["number of strings"])
+        read_fortune = get_fortune_reader(file)
         comment = file["Header"]["delimiting char"] + file["Header"]["delimiting char"]
         found_here = False
 
         for i in range(file["Header"]["number of strings"]):
-            fortune = strfile.read_fortune(filename, offsets[i], file["Header"]["delimiting char"])
+            fortune = read_fortune(i)
 
             if file["Header"]["comments flag"] and fortune.startswith(comment):
                 continue
@@ -613,16 +849,12 @@ def select_fortune(file):
     and file["Header"]["longest length"] <= parameters["Short max length"]:
         return None
 
-    if file["Dirname"]:
-        filename = file["Dirname"] + os.sep + file["Basename"]
-    else:
-        filename = file["Basename"]
-    offsets = strfile.read_strfile_body(filename, file["Header"]["number of strings"])
+    read_fortune = get_fortune_reader(file)
     comment = file["Header"]["delimiting char"] + file["Header"]["delimiting char"]
 
     for _ in range(parameters["Max attempts"]):
         alea = random.randint(0, file["Header"]["number of strings"] - 1)
-        fortune = strfile.read_fortune(filename, offsets[alea], file["Header"]["delimiting char"])
+        fortune = read_fortune(alea)
 
         if parameters["Short only"] and len(fortune) > parameters["Short max length"]:
             continue
@@ -641,6 +873,63 @@ def select_fortune(file):
     return None
 
 
+################################################################################
+def get_typing_time(characters):
+    """Return the time needed to type a number of characters at the reading rate, in seconds"""
+    return characters / parameters["Characters per second"]
+
+
+################################################################################
+def get_wait_time(fortune):
+    """Return the time needed to read a fortune, in seconds"""
+    wait_time = get_typing_time(len(fortune))
+    if wait_time < parameters["Minimum wait"]:
+        wait_time = parameters["Minimum wait"]
+
+    return wait_time
+
+
+################################################################################
+def pick_fortune(fortune_files):
+    """Randomly choose a fortune and return a dictionary describing it"""
+    selected_file = select_fortune_file(fortune_files)
+    fortune = select_fortune(selected_file)
+
+    wait_time = 0
+    if fortune is not None:
+        wait_time = get_wait_time(fortune)
+
+    return {"File": selected_file, "Fortune": fortune, "Wait": wait_time}
+
+
+################################################################################
+async def wait_for_reading(wait_time):
+    """Wait for the reading time returned by pick_fortune() without blocking the event loop"""
+    import asyncio
+
+    await asyncio.sleep(wait_time)
+
+
+################################################################################
+async def type_fortune(fortune, stream=None):
+    """Write a fortune at the reading rate without blocking the event loop"""
+    import asyncio
+
+    if stream is None:
+        stream = sys.stdout
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for i, character in enumerate(fortune):
+        stream.write(character)
+        stream.flush()
+
+        # Schedule from the start time so that delays don't accumulate:
+        delay = start + get_typing_time(i + 1) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
 ################################################################################
 def main():
     """The program's main entry point"""
@@ -649,11 +938,23 @@ def main():
     initialize_debugging(program_name)
     process_environment_variables()
     arguments = process_command_line()
+    if not parameters["Build corpus"]:
+        load_corpus()
     fortune_files = process_arguments(arguments)
 
     exit_status = 0
 
-    if parameters["List files"]:
+    if parameters["Build corpus"]:
+        if not parameters["Corpus file"]:
+            logging.critical("No corpus image file specified in FORTUNE_CORPUS")
+            sys.exit(1)
+        try:
+            write_corpus(fortune_files)
+        except OSError as error:
+            logging.critical("Unable to build the corpus image: %s", error)
+            sys.exit(1)
+
+    elif parameters["List files"]:
         list_files(fortune_files)
 
     elif parameters["Pattern"]:
@@ -661,7 +962,9 @@ def main():
             exit_status = 1
 
     else:
-        selected_file = select_fortune_file(fortune_files)
+        result = pick_fortune(fortune_files)
+        selected_file = result["File"]
+        fortune = result["Fortune"]
 
         if parameters["Show cookie file"]:
             if selected_file["Dirname"]:
@@ -670,17 +973,21 @@ def main():
                 print("({})".format(selected_file["Basename"]))
             print("{}".format(selected_file["Header"]["delimiting char"]))
 
-        fortune = select_fortune(selected_file)
-
         if fortune is None:
             exit_status = 1
         else:
-            print(fortune, end="")
+            wait_time = result["Wait"]
+            if parameters["Typewriter"]:
+                import asyncio
+
+                sys.stdout.flush()
+                asyncio.run(type_fortune(fortune))
+                # Typing the fortune already took part of the reading time:
+                wait_time -= get_typing_time(len(fortune))
+            else:
+                print(fortune, end="")
 
-            if parameters["Wait"]:
-                wait_time = len(fortune) / parameters["Characters per second"]
-                if wait_time < parameters["Minimum wait"]:
-                    wait_time = parameters["Minimum wait"]
+            if parameters["Wait"] and wait_time > 0:
                 time.sleep(wait_time)
 
     sys.exit(exit_status)
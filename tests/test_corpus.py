@@ -0,0 +1,173 @@
+"""Tests for the shared corpus image of the fortune command"""
+
+import importlib
+import os
+import struct
+import sys
+
+import pytest
+
+pytest.importorskip("strfile")
+pytest.importorskip("rot13")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+fortune = importlib.import_module("fortune.main")
+
+FORTUNES = ["hello world\n", "second été\n", "third one\n"]
+
+
+################################################################################
+def parse_cookie_file(name):
+    """Return the fortunes of a '%' delimited cookie file"""
+    with open(name, encoding="utf-8") as file:
+        return file.read().split("%\n")
+
+
+################################################################################
+@pytest.fixture
+def cookie_file(tmp_path, monkeypatch):
+    """Create a cookie file and make the strfile functions read it"""
+    name = str(tmp_path / "fortunes")
+    with open(name, "w", encoding="utf-8") as file:
+        file.write("%\n".join(FORTUNES))
+    with open(name + ".dat", "wb"):
+        pass
+
+    def read_strfile_header(filename):
+        fortunes = parse_cookie_file(filename)
+        return {
+            "number of strings": len(fortunes),
+            "longest length": max(len(fortune) for fortune in fortunes),
+            "shortest length": min(len(fortune) for fortune in fortunes),
+            "delimiting char": "%",
+            "rotated flag": False,
+            "comments flag": False,
+        }
+
+    monkeypatch.setattr(fortune.strfile, "read_strfile_header", read_strfile_header)
+    monkeypatch.setattr(fortune.strfile, "read_strfile_body", lambda filename, number: list(range(number)))
+    monkeypatch.setattr(fortune.strfile, "read_fortune",
+        lambda filename, offset, delimiter: parse_cookie_file(filename)[offset]
+    )
+    monkeypatch.setitem(fortune.parameters, "Corpus file", str(tmp_path / "run" / "corpus"))
+    monkeypatch.setattr(fortune, "corpus", None)
+
+    return name
+
+
+################################################################################
+def build_corpus(name):
+    """Build a corpus image holding a single cookie file"""
+    fortune.write_corpus([fortune.process_file(name)])
+
+
+################################################################################
+def test_round_trip(cookie_file, monkeypatch):
+    """Fortunes are read back from the image without touching the cookie files"""
+    build_corpus(cookie_file)
+    fortune.load_corpus()
+    assert fortune.corpus is not None
+
+    def fail(*_):
+        raise AssertionError("cookie file read despite the corpus image")
+
+    monkeypatch.setattr(fortune.strfile, "read_strfile_header", fail)
+    monkeypatch.setattr(fortune.strfile, "read_strfile_body", fail)
+    monkeypatch.setattr(fortune.strfile, "read_fortune", fail)
+
+    file = fortune.process_file(cookie_file)
+    assert file["Corpus"] is not None
+    assert file["Header"]["number of strings"] == len(FORTUNES)
+
+    read_fortune = fortune.get_fortune_reader(file)
+    assert [read_fortune(i) for i in range(len(FORTUNES))] == FORTUNES
+
+
+################################################################################
+def test_image_is_shareable(cookie_file):
+    """The image and a directory created for it are readable by other users"""
+    old_umask = os.umask(0o077)
+    try:
+        build_corpus(cookie_file)
+    finally:
+        os.umask(old_umask)
+
+    corpus_file = fortune.parameters["Corpus file"]
+    assert os.stat(corpus_file).st_mode & 0o777 == 0o644
+    assert os.stat(os.path.dirname(corpus_file)).st_mode & 0o777 == 0o755
+
+
+################################################################################
+def test_stale_entry_falls_back(cookie_file):
+    """Cookie files changed since the image was built are read from disk"""
+    build_corpus(cookie_file)
+    with open(cookie_file, "a", encoding="utf-8") as file:
+        file.write("%\nfourth\n")
+    fortune.load_corpus()
+
+    file = fortune.process_file(cookie_file)
+    assert file["Corpus"] is None
+    assert file["Header"]["number of strings"] == len(FORTUNES) + 1
+    assert fortune.get_fortune_reader(file)(3) == "fourth\n"
+
+
+################################################################################
+def make_image(index_data):
+    """Return a corpus image made of a signature and an index"""
+    header_size = len(fortune.CORPUS_MAGIC) + 16
+    return fortune.CORPUS_MAGIC + struct.pack("<QQ", header_size, len(index_data)) + index_data
+
+
+################################################################################
+def flip_first_character(image):
+    """Replace the first byte of the first fortune of an image with an invalid UTF-8 one"""
+    table = len(fortune.CORPUS_MAGIC) + 16
+    start = struct.unpack_from("<Q", image, table)[0]
+    return image[:start] + b"\xff" + image[start + 1:]
+
+
+################################################################################
+def break_first_offset(image):
+    """Make the first fortune of an image end beyond the image"""
+    table = len(fortune.CORPUS_MAGIC) + 16
+    return image[:table + 8] + struct.pack("<Q", len(image) + 1) + image[table + 16:]
+
+
+################################################################################
+@pytest.mark.parametrize("damage, expected", [
+    (lambda image: b"not a corpus image", FORTUNES[0]),
+    (lambda image: fortune.CORPUS_MAGIC, FORTUNES[0]),
+    (lambda image: make_image(b"{"), FORTUNES[0]),
+    (lambda image: make_image(b"[]"), FORTUNES[0]),
+    (lambda image: make_image(b'{"x": "y"}'), FORTUNES[0]),
+    (lambda image: make_image(
+        b'{"x": {"Stamps": [], "Header": {"number of strings": 99, "delimiting char": "%"}, "Table": 0}}'
+    ), FORTUNES[0]),
+    (lambda image: image.replace(b'"comments flag": false', b'"comments": false'), FORTUNES[0]),
+    (lambda image: image.replace(b'"rotated flag": false', b'"rotated flag": "no!"'), FORTUNES[0]),
+    (break_first_offset, FORTUNES[0]),
+    (flip_first_character, "\ufffd" + FORTUNES[0][1:]),
+])
+def test_damaged_image_falls_back(cookie_file, damage, expected):
+    """Damaged images are ignored with a warning"""
+    build_corpus(cookie_file)
+    corpus_file = fortune.parameters["Corpus file"]
+    with open(corpus_file, "rb") as file:
+        image = file.read()
+    with open(corpus_file, "wb") as file:
+        file.write(damage(image))
+
+    fortune.load_corpus()
+    file = fortune.process_file(cookie_file)
+    assert fortune.get_fortune_reader(file)(0) == expected
+
+
+################################################################################
+def test_failed_build_leaves_no_temporary_file(cookie_file):
+    """A failed build does not leave its temporary file behind"""
+    corpus_file = fortune.parameters["Corpus file"]
+    os.makedirs(corpus_file)
+
+    with pytest.raises(OSError):
+        build_corpus(cookie_file)
+    assert os.listdir(os.path.dirname(corpus_file)) == ["corpus"]
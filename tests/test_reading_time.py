@@ -0,0 +1,143 @@
+"""Tests for the reading time and non-blocking output of the fortune command"""
+
+import asyncio
+import importlib
+import io
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("strfile")
+pytest.importorskip("rot13")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+fortune = importlib.import_module("fortune.main")
+
+
+################################################################################
+@pytest.fixture
+def reading_rate(monkeypatch):
+    """Use a known reading rate"""
+    monkeypatch.setitem(fortune.parameters, "Characters per second", 100)
+    monkeypatch.setitem(fortune.parameters, "Minimum wait", 0.5)
+
+
+################################################################################
+def choose(monkeypatch, text):
+    """Make the fortune selection return the given text"""
+    selected_file = {"Dirname": "", "Basename": "fortunes", "Header": {"delimiting char": "%"}}
+    monkeypatch.setattr(fortune, "select_fortune_file", lambda fortune_files: selected_file)
+    monkeypatch.setattr(fortune, "select_fortune", lambda file: text)
+
+
+################################################################################
+def test_pick_fortune_wait(reading_rate, monkeypatch):
+    """The reading time depends on the fortune length"""
+    choose(monkeypatch, "x" * 200)
+    result = fortune.pick_fortune([])
+    assert result["Fortune"] == "x" * 200
+    assert result["Wait"] == 2
+
+
+################################################################################
+def test_pick_fortune_minimum_wait(reading_rate, monkeypatch):
+    """Short fortunes get the minimum reading time"""
+    choose(monkeypatch, "short\n")
+    assert fortune.pick_fortune([])["Wait"] == 0.5
+
+
+################################################################################
+def test_pick_fortune_not_found(reading_rate, monkeypatch):
+    """There's nothing to read when no fortune is found"""
+    choose(monkeypatch, None)
+    result = fortune.pick_fortune([])
+    assert result["Fortune"] is None
+    assert result["Wait"] == 0
+
+
+################################################################################
+def test_type_fortune(monkeypatch):
+    """Fortunes are typed at the reading rate"""
+    monkeypatch.setitem(fortune.parameters, "Characters per second", 1000)
+    stream = io.StringIO()
+    text = "abcdefghij\n" * 10
+
+    start = time.monotonic()
+    asyncio.run(fortune.type_fortune(text, stream))
+    elapsed = time.monotonic() - start
+
+    assert stream.getvalue() == text
+    assert elapsed >= 0.9 * fortune.get_typing_time(len(text))
+
+
+################################################################################
+def test_type_fortune_concurrently(monkeypatch):
+    """Several fortunes can be typed at the same time"""
+    monkeypatch.setitem(fortune.parameters, "Characters per second", 1000)
+    streams = [io.StringIO(), io.StringIO()]
+    text = "x" * 100
+
+    async def type_both():
+        await asyncio.gather(*(fortune.type_fortune(text, stream) for stream in streams))
+
+    start = time.monotonic()
+    asyncio.run(type_both())
+    elapsed = time.monotonic() - start
+
+    assert [stream.getvalue() for stream in streams] == [text, text]
+    assert elapsed < 2 * fortune.get_typing_time(len(text))
+
+
+################################################################################
+def test_wait_for_reading():
+    """Waiting for the reading time doesn't block other tasks"""
+    ticks = []
+
+    async def tick():
+        for _ in range(3):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def wait_and_tick():
+        await asyncio.gather(fortune.wait_for_reading(0.1), tick())
+
+    start = time.monotonic()
+    asyncio.run(wait_and_tick())
+    elapsed = time.monotonic() - start
+
+    assert elapsed >= 0.1
+    assert len(ticks) == 3
+    assert ticks[-1] - start < 0.1
+
+
+################################################################################
+@pytest.mark.parametrize("options, typed", [
+    (["-w"], False),
+    (["--typewriter", "-w"], True),
+])
+def test_main_wait(reading_rate, monkeypatch, capsys, options, typed):
+    """The typing time is deducted from the wait when using the typewriter mode"""
+    text = "x" * 200
+    choose(monkeypatch, text)
+    monkeypatch.setattr(sys, "argv", ["fortune"] + options)
+    monkeypatch.setattr(fortune, "initialize_debugging", lambda program_name: None)
+    monkeypatch.setattr(fortune, "process_environment_variables", lambda: None)
+    monkeypatch.setattr(fortune, "load_corpus", lambda: None)
+    monkeypatch.setattr(fortune, "process_arguments", lambda arguments: [])
+    monkeypatch.setitem(fortune.parameters, "Wait", False)
+    monkeypatch.setitem(fortune.parameters, "Typewriter", False)
+    monkeypatch.setitem(fortune.parameters, "Characters per second", 10000)
+    sleeps = []
+    monkeypatch.setattr(fortune.time, "sleep", sleeps.append)
+
+    with pytest.raises(SystemExit) as exit_status:
+        fortune.main()
+
+    assert exit_status.value.code == 0
+    assert capsys.readouterr().out == text
+    if typed:
+        assert sleeps == [pytest.approx(0.5 - fortune.get_typing_time(len(text)))]
+    else:
+        assert sleeps == [0.5]